@@ -1,21 +1,106 @@
+import io
 import os
-from dataclasses import dataclass, field
+import re
+import sys
+import time
+import fnmatch
+import warnings
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, fields
 import pandas as pd
 import s3
-from utils import unpickle, make_pickle
+from utils import unpickle, make_pickle, list_s3, upload_fileobj, DEFAULT_PROTOCOL
 
+_WILDCARD = re.compile(r'[*?\[]')
 
+# slotted dataclasses drop the per-instance __dict__, available from Python 3.10
+_SLOTS = {'slots': True} if sys.version_info >= (3, 10) else {}
+
+# seconds for which the member keys of an array DataSet are cached
+KEYS_TTL = 300
+_KEYS_CACHE_SIZE = 128
+_KEYS_CACHE = OrderedDict()  # (s3_path, suffix) -> (fetch time, keys)
+
+
+@functools.lru_cache(maxsize=8192)
 def format_jira(jid: str) -> str:
     """
-    Transforms jira ID to keep same notation across the project.
+    Transforms jira ID to keep same notation across the project. Results are cached as the
+    same IDs come up for every DataSet of a crawl.
     :param jid: Jira ID (ex: SGDS-123, or OMICS-456_do_something)
     """
+    if jid.islower() and jid.isalnum():  # already formatted
+        return jid
     jid = jid.lower().strip()
     jid = jid.split('_')[0]
     j = "".join(jid.split('-'))
     return j
 
 
+def _s3_join(*parts: str) -> str:
+    """
+    Join S3 path components with `/`, skipping empty ones. Unlike `os.path.join`, this
+    never uses the local separator and tolerates None components.
+    :param parts: S3 prefix followed by path components
+    """
+    return '/'.join(p.strip('/') if i else p.rstrip('/') for i, p in enumerate(parts) if p)
+
+
+# compressed file suffixes that are recorded under the format of the file they wrap,
+# like the gzipped CSVs written by `DataSet.from_df`
+_COMPRESSED_FORMATS = {'csv.gz': 'CSV'}
+
+
+def _split_ext(base: str) -> tuple:
+    """
+    Split a file name into its name and extension, where `.csv.gz` is a single extension
+    :param base: file name
+    :return: (name, ext), ext is '' for files without an extension
+    """
+    for ext in _COMPRESSED_FORMATS:
+        if len(base) > len(ext) + 1 and base.lower().endswith('.' + ext):
+            return base[:-len(ext) - 1], base[-len(ext):]
+    name, dot, ext = base.rpartition('.')
+    return (name, ext) if dot else (base, '')
+
+
+def _ext_format(ext: str) -> str:
+    """
+    DataSet format for a file extension. Formats come from a small alphabet, interning shares
+    one str per format.
+    :param ext: file extension, as returned by `_split_ext`
+    """
+    if not ext:
+        return 'NA'
+    return sys.intern(_COMPRESSED_FORMATS.get(ext.lower(), ext.upper()))
+
+
+def _array_keys(s3_path: str, suffix: str) -> tuple:
+    """
+    List the member keys of an array DataSet, 1000 keys per ListObjectsV2 page. Listings
+    are cached for `KEYS_TTL` seconds after they were fetched, for the 128 most recently
+    used arrays.
+    :param s3_path: S3 prefix of the array
+    :param suffix: file extension of the array members
+    """
+    cache_key = (s3_path, suffix)
+    now = time.monotonic()
+    cached = _KEYS_CACHE.get(cache_key)
+    if cached and now - cached[0] < KEYS_TTL:
+        _KEYS_CACHE.move_to_end(cache_key)
+        return cached[1]
+
+    keys = tuple(p.rpartition('/')[2].split('.')[0] for p in list_s3(s3_path, page_size=1000)
+                 if p.endswith(suffix))
+    _KEYS_CACHE[cache_key] = (now, keys)
+    _KEYS_CACHE.move_to_end(cache_key)
+    while len(_KEYS_CACHE) > _KEYS_CACHE_SIZE:
+        _KEYS_CACHE.popitem(last=False)
+    return keys
+
+
 def _build_s3_path(s3_basepath: str, jira_issue: str, loc_path: str, subfolder: str = None) -> str:
     """
     Build an s3 path with optional subfolder
@@ -24,7 +109,7 @@ def _build_s3_path(s3_basepath: str, jira_issue: str, loc_path: str, subfolder:
     :param loc_path: Local path of file
     :param subfolder: Name of optional subfolder
     """
-    return os.path.join(s3_basepath, format_jira(jira_issue), subfolder, os.path.basename(loc_path))
+    return _s3_join(s3_basepath, format_jira(jira_issue), subfolder, os.path.basename(loc_path))
 
 
 @dataclass
@@ -36,6 +121,9 @@ class Catalog:
     :param s3_basepath: S3 prefix path to the project files
     :param contents: dict of DataSet objects
     :param fresh: If True, create a new Catalog from scratch, if False, read in the pickle from cat_path
+    :param protocol: pickle protocol used when saving the catalog
+    :param compress: gzip the catalog pickle when saving
+    :param max_workers: number of threads used to list Jira prefixes on S3 concurrently
     """
 
     # get repo paths
@@ -44,9 +132,12 @@ class Catalog:
     contents: dict = field(init=False)
     fresh: bool = False
     verbose: bool = False
+    protocol: int = DEFAULT_PROTOCOL
+    compress: bool = True
+    max_workers: int = 32
+    _flat: list = field(init=False, repr=False, compare=False, default_factory=list)
 
     def __post_init__(self):
-
         if self.fresh:
             self.create()
 
@@ -58,6 +149,7 @@ class Catalog:
                 print(f'ERROR Reading in Catalog pickle from {self.cat_path}. {e}.'
                       f'Generating empty catalog.')
                 self.contents = {}
+            self._reindex()
             if self.verbose:
                 print(f'Initialized Catalog with {len(self.contents)} records.')
 
@@ -69,12 +161,13 @@ class Catalog:
         Create a new catalog from scratch. Crawls the s3_basepath to collect all DataSet objects.
         """
         self.contents = {}
-        for jira_path in s3.ls(self.s3_basepath):
+        for jira_path, s3_list in self._ls_many(s3.ls(self.s3_basepath)).items():
             jira_issue = format_jira(jira_path.split('/')[-2])
             if self.verbose:
                 print(f'Creating JIRA issue {jira_issue}...')
             self.contents[jira_issue] = {}
-            self._update(s3.ls(jira_path), jira_issue)
+            self._update(s3_list, jira_issue)
+        self._reindex()
         self._save()
 
     def update(self, jira_issue: str = None, format_jid: bool = True, arrays: bool = False) -> None:
@@ -91,11 +184,10 @@ class Catalog:
             jira_issue = format_jira(jira_issue) if format_jid else jira_issue
 
             # Look for the s3 path corresponding to this jira item
-            jira_path = s3.ls(self.s3_basepath, pattern=jira_issue)
-            if len(jira_path) != 1:
-                raise ValueError(f"Found {len(jira_path)} prefixes matching {jira_issue}.")
-            else:
-                jira_path = jira_path[0]
+            jira_path = self._find_jira_prefix(jira_issue)
+            if _WILDCARD.search(jira_issue):  # record under the matched issue, not the pattern
+                jira_issue = jira_path.split('/')[-2]
+                jira_issue = format_jira(jira_issue) if format_jid else jira_issue
 
             s3_list = s3.ls(jira_path)
             self.contents[jira_issue] = {}
@@ -103,43 +195,110 @@ class Catalog:
 
         else:  # update all not yet in Catalog
             print('Scanning for new records...')
-            for jira_path in s3.ls(self.s3_basepath):
-                jira_issue = format_jira(jira_path.split('/')[-2])
-                if jira_issue not in self.contents:
-                    print(f'Creating JIRA issue {jira_issue}...')
-                    s3_list = s3.ls(jira_path)
-                    self.contents[jira_issue] = {}
-                    self._update(s3_list, jira_issue, arrays=arrays)
+            # only list the issues missing from the catalog; as before, the first prefix
+            # found for a Jira ID wins
+            known = set(self.contents)
+            to_fetch = {}
+            for p in s3.ls(self.s3_basepath):
+                jira_issue = format_jira(p.split('/')[-2])
+                if jira_issue not in known:
+                    known.add(jira_issue)
+                    to_fetch[p] = jira_issue
+            for jira_path, s3_list in self._ls_many(to_fetch).items():
+                jira_issue = to_fetch[jira_path]
+                print(f'Creating JIRA issue {jira_issue}...')
+                self.contents[jira_issue] = {}
+                self._update(s3_list, jira_issue, arrays=arrays)
 
+        self._reindex()
         self._save()
 
     def search(self, **kwargs: dict) -> list:
-        results = []
-        for jira, cont in self.contents.items():
-            results.extend([i for i in cont if all(kwargs[k] in i[k] for k in kwargs)])
+        """
+        Search DataSets by attribute, ex: `search(format='JSON', dtype='array')`. A DataSet
+        matches if every value is a substring of the corresponding attribute.
+        :param kwargs: DataSet attribute names and the values to look for
+        :return: list of matching DataSet objects
+        """
+        results = [d for d in self._flat
+                   if all(str(v) in str(getattr(d, k, None) or '') for k, v in kwargs.items())]
         if results:
             print(f'Found {len(results)} results for search: {str(kwargs)}')
         return results
 
     def _save(self) -> None:
-        make_pickle(self.contents, self.cat_path, verbose=self.verbose)
+        make_pickle(self.contents, self.cat_path, verbose=self.verbose, protocol=self.protocol,
+                    compress=self.compress)
         if self.verbose:
             print(f'Catalog was saved to {self.cat_path}')
 
+    def _reindex(self) -> None:
+        """Rebuild the flat list of DataSets scanned by `search` from `contents`"""
+        self._flat = []
+        for records in self.contents.values():
+            for record in records.values():
+                self._flat.extend(record.values() if isinstance(record, dict) else [record])
+
+    def _find_jira_prefix(self, jira_issue: str) -> str:
+        """
+        Find the S3 prefix of a Jira issue with bounded listings, rather than listing every
+        issue under `s3_basepath`.
+        :param jira_issue: formatted Jira ID, may contain shell-style wildcards
+        :return: S3 prefix of the Jira issue
+        """
+        base = self.s3_basepath.rstrip('/') + '/'
+
+        wildcard = _WILDCARD.search(jira_issue)
+        if wildcard:
+            # only list prefixes sharing the literal head of the pattern, and match the
+            # rest locally with a regex compiled once
+            pattern = re.compile(fnmatch.translate(jira_issue + '/'))
+            jira_path = [p for p in list_s3(base + jira_issue[:wildcard.start()])
+                         if pattern.match(p[len(base):])]
+            if len(jira_path) != 1:
+                raise ValueError(f"Found {len(jira_path)} prefixes matching {jira_issue}.")
+            return jira_path[0]
+
+        # Try the exact prefix first: `-` and `.` sort before `/`, so siblings such as
+        # `jid123-old/` can crowd `jid123/` out of a bounded listing of `jid123`
+        if next(list_s3(base + jira_issue + '/', max_keys=1), None):
+            return base + jira_issue + '/'
+
+        # only prefixes count towards the bound, so loose files such as `jid123.csv` can't
+        # hide a second matching prefix
+        jira_path = list(list_s3(base + jira_issue, max_keys=2, prefixes_only=True))
+        if len(jira_path) != 1:
+            raise ValueError(f"Found {len(jira_path)} prefixes matching {jira_issue}.")
+        return jira_path[0]
+
+    def _ls_many(self, s3_paths: list) -> dict:
+        """
+        List several S3 prefixes concurrently. Listings are network-bound, so threads
+        overlap the round-trips; results are returned to the caller thread to be merged.
+        :param s3_paths: S3 prefixes to list
+        :return: dict mapping each prefix to its listing, in input order
+        """
+        s3_paths = list(s3_paths)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as ex:
+            return dict(zip(s3_paths, ex.map(s3.ls, s3_paths)))
+
     def _update(self, s3_list: list, jira_issue: str, arrays: bool = True):
+        # split subfolders from lone files in a single pass
+        folders, file_list = [], []
+        for p in s3_list:
+            (folders if s3.is_prefix(p) else file_list).append(p)
+
         # add any subfolder contents
-        folders = [p for p in s3_list if s3.is_prefix(p)]
         for prefix in folders:
             self._gen_array_records(s3.ls(prefix), jira_issue)
 
         # add any lone files
-        file_list = [p for p in s3_list if p not in folders]
         if arrays and len(file_list) > 10:
             self._gen_array_records(file_list, jira_issue)
         else:
             for fp in file_list:
-                name, ext = os.path.basename(fp).rsplit('.', 1)
-                dataset = DataSet(jira_issue, fp, format=ext.upper(), dtype='file')
+                name, ext = _split_ext(fp.rpartition('/')[2])
+                dataset = DataSet(jira_issue, fp, format=_ext_format(ext), dtype='file')
 
                 # Look for an existing dataset or set of datasets with this name
                 if name in self.contents[jira_issue]:
@@ -148,8 +307,10 @@ class Catalog:
                         ds[ext] = dataset
                         dataset = ds
                     else:
+                        # key by extension, `feat.csv` and `feat.csv.gz` share a format
+                        ds_ext = _split_ext(ds.s3_path.rpartition('/')[2])[1]
                         dataset = {
-                            ds.format.lower(): ds,
+                            (ds_ext or ds.format).lower(): ds,
                             ext.lower(): dataset
                         }
 
@@ -157,39 +318,49 @@ class Catalog:
                 self.contents[jira_issue][name] = dataset
 
     def _gen_array_records(self, array_list, jira_issue):
-        bpath = os.path.dirname(array_list[0])
-
-        # define arrays by file extensions, skip subfolders
-        ext = set([c.split('.')[-1] for c in array_list if not c.endswith('/')])
-
-        for e in ext:
+        bpath = array_list[0].rpartition('/')[0]
+        bname = bpath.rpartition('/')[2]
+
+        # define arrays by file extensions in a single pass, skip subfolders. Files without
+        # an extension are keyed by their own path.
+        ext = {}
+        for rec in array_list:
+            if not rec.endswith('/'):
+                base = rec.rpartition('/')[2]
+                e = _split_ext(base)[1]
+                if e:
+                    ext.setdefault(e, []).append(base)
+                else:
+                    ext.setdefault(rec, [])
+
+        for e, r in ext.items():
+            fmt = _ext_format(e)
 
             # make a distinct array for each file format/extension, even if they share the
             # same subfolder
             if len(ext) > 1:
-                name = '_'.join([os.path.basename(bpath), e.upper(), 'array'])
+                name = '_'.join([bname, e.upper(), 'array'])
             else:
-                name = '_'.join([os.path.basename(bpath), 'array'])
+                name = '_'.join([bname, 'array'])
 
-            r = [os.path.basename(rec) for rec in array_list if rec.endswith('.' + e)]
             if len(r) == 0:  # single file no extension
                 meta = {'format': 'NA', 'dtype': 'file'}
                 fp = e
 
             elif len(r) == 1:  # single file
-                fp = os.path.join(bpath, r[0])
-                meta = {'format': e.upper(), 'dtype': 'file'}
+                fp = _s3_join(bpath, r[0])
+                meta = {'format': fmt, 'dtype': 'file'}
 
             else:
                 # make a dummy path to show regex pattern of array files
-                repr_path = os.path.join(bpath, self._gen_repr_path(r))
+                repr_path = _s3_join(bpath, self._gen_repr_path(r))
                 fp = bpath + '/'
                 meta = {
                     'count': len(r),
-                    'format': e.upper(),
+                    'format': fmt,
                     'dtype': 'array',
                     'regex': repr_path,
-                    'example': os.path.join(bpath, r[0])
+                    'example': _s3_join(bpath, r[0])
                 }
 
             dataset = DataSet(jira_issue, fp, **meta)
@@ -197,23 +368,13 @@ class Catalog:
 
     @staticmethod
     def _gen_repr_path(arr):
-        temp = arr[0]
-        root = ''
-        for char in temp:
-            if all(a.startswith(root + char) for a in arr):
-                root += char
-            else:
-                break
-        end = ''
-        for char in temp[::-1]:
-            if all(v.endswith(char + end) for v in arr):
-                end = char + end
-            else:
-                break
+        # character-wise common prefix/suffix, computed in C by commonprefix
+        root = os.path.commonprefix(arr)
+        end = os.path.commonprefix([a[::-1] for a in arr])[::-1]
         return root + '*' + end
 
 
-@dataclass
+@dataclass(**_SLOTS)
 class DataSet:
     """
     DataSet object facilitates read/writes of analysis outputs.
@@ -235,29 +396,45 @@ class DataSet:
 
     def __repr__(self):
         repr = f'DataSet object from {self.jira_issue.upper()}:'
-        for attr, val in self.__dict__.items():
-            if val and attr != 'jira_issue':
-                repr += f'\n\t- {attr}: {val}'
+        for f in fields(self):
+            val = getattr(self, f.name)
+            if val and f.name != 'jira_issue':
+                repr += f'\n\t- {f.name}: {val}'
         return repr
 
     def __post_init__(self):
         self.jira_issue = format_jira(self.jira_issue)
 
+    def __getstate__(self):
+        return {f.name: getattr(self, f.name) for f in fields(self)}
+
+    def __setstate__(self, state):
+        # state is a plain dict of attributes, as in catalogs pickled before DataSet had
+        # slots; attributes that are no longer DataSet fields are dropped
+        for f in fields(self):
+            setattr(self, f.name, state.get(f.name))
+
     def _get_object_path(self, key):
         if self.dtype == 'array':  # build s3 path using key
             if not key or not self.format:
                 raise ValueError('Unable to download DataSet array member without key or format.')
-            return os.path.join(self.s3_path, f'{key}.{self.format.lower()}')
+            return _s3_join(self.s3_path, f'{key}.{self._member_ext}')
         return self.s3_path
 
+    @property
+    def _member_ext(self) -> str:
+        # extension of array members, ex: `csv.gz` for gzipped CSVs recorded as format CSV
+        if self.example:
+            return _split_ext(self.example.rpartition('/')[2])[1]
+        return self.format.lower()
+
     @property
     def keys(self):
         """Get existing keys for an array DataSet, which can be used in `read` and
         `download` functions to access an array member"""
         if self.dtype != 'array':
             raise TypeError('Property `keys` only exists for DataSet arrays')
-        return [os.path.basename(p).split('.')[0] for p in
-                s3.ls(self.s3_path, suffix=self.format.lower())]
+        return list(_array_keys(self.s3_path, self._member_ext))
 
     def download(self, key: str = None, tmp: str = '/tmp/') -> str:
         """
@@ -268,13 +445,26 @@ class DataSet:
         path = self._get_object_path(key)
         return s3.copy(path, dest=tmp, verbose=False)
 
+    def download_many(self, keys: list = None, tmp: str = '/tmp/', max_workers: int = 16) -> list:
+        """
+        Download several members of an array DataSet concurrently, return local paths
+        :param keys: names of the array members to download. If None, download all of them.
+        :param tmp: Local dir files are written to
+        :param max_workers: number of concurrent downloads
+        """
+        keys = self.keys if keys is None else keys
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            return list(ex.map(lambda k: self.download(k, tmp=tmp), keys))
+
     def read(self, idx: (int, str) = 0, key: str = None, **kwargs) -> pd.DataFrame:
         """
-        Stream data from S3. Uses pandas.read method if file is a CSV
+        Stream data from S3. Uses pandas.read method if file is a Parquet or CSV
         :param key: For array DataSet objects, specifies name of array member to stream.
-        :param idx: `index_col` kwarg for pandas.read method
+        :param idx: `index_col` kwarg for pandas.read_csv, Parquet files store their index
         """
         path = self._get_object_path(key)
+        if self.format == 'PARQUET':
+            return pd.read_parquet(path, **kwargs)
         if self.format == 'CSV':
             return pd.read_csv(path, index_col=idx, **kwargs)
         return s3.read(path, **kwargs)
@@ -291,13 +481,38 @@ class DataSet:
 
     @classmethod
     def from_df(cls, dataframe: pd.DataFrame, name: str, jira_issue: str, s3_basepath: str,
-                subfolder: str = None, tmp: str = '/tmp/'):
-        """Create a DataSet object from a pandas data frame"""
+                subfolder: str = None, tmp: str = None, format: str = 'PARQUET',
+                compress: bool = False):
+        """
+        Create a DataSet object from a pandas data frame. The file is serialized in memory
+        and streamed to S3, with no temporary local copy.
+        :param tmp: Deprecated and ignored, nothing is written locally anymore
+        :param format: PARQUET (snappy compressed) or CSV
+        :param compress: gzip a CSV, the object is then saved as `<name>.csv.gz`
+        """
+        if tmp is not None:
+            warnings.warn('`tmp` is deprecated and ignored by DataSet.from_df',
+                          DeprecationWarning, stacklevel=2)
+
+        format = format.upper()
+        if format == 'PARQUET':
+            ext = '.parquet'
+        elif format == 'CSV':
+            ext = '.csv.gz' if compress else '.csv'
+        else:
+            raise ValueError(f'Unsupported format {format}, expected PARQUET or CSV.')
 
-        s3_path = _build_s3_path(s3_basepath, jira_issue, name + '.csv', subfolder=subfolder)
+        s3_path = _build_s3_path(s3_basepath, jira_issue, name + ext, subfolder=subfolder)
         print(s3_path)
         # dataframe.to_csv(s3_path)  # this fails silently when using credentials
         # (as opposed to with an instance role). Filed LUCHA-1780
-        dataframe.to_csv(f'{tmp}{name}.csv')
-        s3.copy(f'{tmp}{name}.csv', dest=s3_path, verbose=False)
-        return cls(jira_issue, s3_path, format='CSV', dtype='file')
+        # pandas' own s3:// writer is avoided, the buffer is uploaded with boto3
+        buf = io.BytesIO()
+        if format == 'PARQUET':
+            dataframe.to_parquet(buf, compression='snappy')
+        else:
+            dataframe.to_csv(buf, compression='gzip' if compress else None)
+        buf.seek(0)
+        upload_fileobj(buf, s3_path)
+        return cls(jira_issue, s3_path, format=format, dtype='file')
+
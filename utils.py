@@ -1,37 +1,227 @@
+import os
 import sys
+import glob
+import gzip
+import mmap
 import pickle
+import struct
+import functools
+import contextlib
 
+# protocol 5 (PEP 574) is the highest available on Python 3.8+
+DEFAULT_PROTOCOL = min(pickle.HIGHEST_PROTOCOL, 5)
 
-def make_pickle(obj: object, path: str, verbose: bool = False) -> None:
+# out-of-band buffers need PickleBuffer and protocol 5
+OUT_OF_BAND_SUPPORTED = sys.version_info >= (3, 8)
+BUFFERS_SUFFIX = '.buffers'
+_BUFFER_LEN = struct.Struct('<Q')
+# first pickle of an out-of-band stream, followed by the token naming its sidecar
+_BUFFERS_HEADER = 'catalog-out-of-band-buffers'
+_TOKEN_BYTES = 8
+_TOKEN_GLOB = '[0-9a-f]' * 2 * _TOKEN_BYTES
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+@contextlib.contextmanager
+def _atomic_write(path: str, compress: bool = False):
+    """
+    Open `path` for writing through a temporary file, which is fsynced and renamed over
+    `path` only once writing succeeded, so a crash never leaves a truncated file behind.
+    :param path: Local path to write to
+    :param compress: gzip the written stream
+    """
+    tmp = f'{path}.tmp.{os.getpid()}'
+    try:
+        with open(tmp, 'wb') as raw_f:
+            if compress:
+                # level 1 is close to memcpy speed and already shrinks the catalog many times.
+                # A fixed mtime keeps the bytes identical for identical contents, so an
+                # unchanged catalog does not show up as modified in its repository.
+                with gzip.GzipFile(os.path.basename(path), mode='wb', compresslevel=1,
+                                   fileobj=raw_f, mtime=0) as gz_f:
+                    yield gz_f
+            else:
+                yield raw_f
+            raw_f.flush()
+            os.fsync(raw_f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def make_pickle(obj: object, path: str, verbose: bool = False,
+                protocol: int = DEFAULT_PROTOCOL, out_of_band: bool = False,
+                compress: bool = True) -> None:
     """
     Pickle `obj` to the specified `path`
     :param obj: A pickable object
     :param path: A local path that can be written to
     :param verbose:
+    :param protocol: pickle protocol to write with, `unpickle` detects it automatically
+    :param out_of_band: write large buffers (numpy arrays, pandas frames) to a
+                        `<path>.<token>.buffers` sidecar instead of copying them into the pickle
+    :param compress: gzip the pickle stream, by convention `path` then ends in `.pkl.gz`
     :return: None
     """
     if verbose:
         print(f'Pickling {path}')
-    with open(path, 'wb') as pickle_f:
-        pickle.dump(obj, pickle_f)
+    token = None
+    if out_of_band and OUT_OF_BAND_SUPPORTED:
+        # each save gets a new sidecar, so replacing the pickle is the single atomic switch
+        # between the old pickle and buffers and the new ones
+        token = os.urandom(_TOKEN_BYTES).hex()
+        with _atomic_write(path, compress) as pickle_f, \
+                _atomic_write(_buffers_path(path, token)) as buffers_f:
+
+            def write_buffer(buf):
+                # each buffer is written with a length prefix, a None return keeps it
+                # out of the main pickle stream
+                raw = buf.raw()
+                buffers_f.write(_BUFFER_LEN.pack(raw.nbytes))
+                buffers_f.write(raw)
+
+            pickle.dump((_BUFFERS_HEADER, token), pickle_f, protocol=5)
+            pickle.dump(obj, pickle_f, protocol=5, buffer_callback=write_buffer)
+    else:
+        with _atomic_write(path, compress) as pickle_f:
+            pickle.dump(obj, pickle_f, protocol=protocol)
+
+    # sidecars of previous saves are no longer referenced by the pickle
+    for stale in glob.glob(_buffers_path(glob.escape(os.fspath(path)), _TOKEN_GLOB)):
+        if token is None or stale != _buffers_path(path, token):
+            os.remove(stale)
     if verbose:
         print(f'Done pickling to {path}')
     sys.stdout.flush()
     return
 
 
+@contextlib.contextmanager
+def _mmap_or_file(file_obj):
+    """
+    Memory-map an open file for reading so the OS only pages in the bytes that are read,
+    falling back to the file itself where mapping fails (empty files, some network FS).
+    :param file_obj: file opened in binary read mode
+    """
+    try:
+        mapped = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):
+        yield file_obj
+        return
+    with mapped:
+        yield mapped
+
+
 def unpickle(path: str, verbose: bool = False) -> object:
     """
-    Unpickle a pickle!
+    Unpickle a pickle! Gzipped pickles are detected from their magic bytes.
     :param path: Local path to pickled object
     :param verbose:
     :return: unpickled object
     """
     if verbose:
         print(f'Unpickling {path}')
-    with open(path, 'rb') as pickled_obj:
+    with open(path, 'rb') as raw_f, _mmap_or_file(raw_f) as src:
+        compressed = src.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+        src.seek(0)
+        pickled_obj = gzip.GzipFile(fileobj=src, mode='rb') if compressed else src
         obj = pickle.load(pickled_obj)
+        if isinstance(obj, tuple) and len(obj) == 2 and obj[0] == _BUFFERS_HEADER:
+            buffers = _read_buffers(_buffers_path(path, obj[1]))
+            obj = pickle.Unpickler(pickled_obj, buffers=iter(buffers)).load()
     if verbose:
         print(f'Done unpickling {path}')
     sys.stdout.flush()
     return obj
+
+
+def _buffers_path(path: str, token: str) -> str:
+    return f'{path}.{token}{BUFFERS_SUFFIX}'
+
+
+def _read_buffers(buffers_path: str) -> list:
+    """
+    Read the out-of-band buffers written by `make_pickle`
+    :param buffers_path: Local path to the buffers sidecar
+    :return: list of memoryviews over the sidecar contents
+    """
+    # read into a bytearray so unpickled arrays stay writable
+    data = memoryview(bytearray(os.path.getsize(buffers_path)))
+    with open(buffers_path, 'rb') as buffers_f:
+        buffers_f.readinto(data)
+    buffers, offset = [], 0
+    while offset < len(data):
+        (size,) = _BUFFER_LEN.unpack_from(data, offset)
+        offset += _BUFFER_LEN.size
+        buffers.append(data[offset:offset + size])
+        offset += size
+    return buffers
+
+
+@functools.lru_cache(maxsize=None)
+def _s3_client():
+    """
+    Shared boto3 S3 client for bounded listings and in-memory uploads. Credentials come
+    from the default AWS provider chain: environment variables, then the shared
+    credentials/config files (`AWS_PROFILE`), then the container or instance role.
+    """
+    import boto3  # only needed for direct ListObjectsV2 calls and uploads
+    return boto3.client('s3')
+
+
+def _split_s3_path(s3_path: str) -> tuple:
+    """
+    Split an S3 URI into bucket and key
+    :param s3_path: path of the form s3://bucket/key
+    :return: (bucket, key)
+    """
+    bucket, _, key = s3_path.replace('s3://', '', 1).partition('/')
+    return bucket, key
+
+
+def list_s3(s3_path: str, delimiter: str = '/', max_keys: int = None,
+            page_size: int = 1000, prefixes_only: bool = False):
+    """
+    Lazily list everything on S3 starting with `s3_path`, using paginated ListObjectsV2.
+    Unlike `s3.ls`, the listing can be bounded so that existence checks cost a single call.
+    :param s3_path: S3 prefix to list, does not need to end on a `delimiter`
+    :param delimiter: group keys sharing a prefix up to this character into one entry
+    :param max_keys: stop after this many entries, None lists the entire prefix
+    :param page_size: number of entries requested per ListObjectsV2 call (max 1000)
+    :param prefixes_only: only yield (and count towards `max_keys`) common prefixes, files
+                          are skipped
+    :return: generator of S3 paths, prefixes end with `delimiter`
+    """
+    bucket, prefix = _split_s3_path(s3_path)
+    kwargs = {'Bucket': bucket, 'Prefix': prefix, 'Delimiter': delimiter}
+    remaining = max_keys
+    while remaining is None or remaining > 0:
+        # files also use up MaxKeys, so it can only be tightened when they are wanted too
+        bounded = remaining is not None and not prefixes_only
+        kwargs['MaxKeys'] = min(page_size, remaining) if bounded else page_size
+        resp = _s3_client().list_objects_v2(**kwargs)
+        keys = [p['Prefix'] for p in resp.get('CommonPrefixes', [])]
+        if not prefixes_only:
+            keys = sorted(keys + [o['Key'] for o in resp.get('Contents', [])])
+        if remaining is not None:
+            keys = keys[:remaining]
+            remaining -= len(keys)
+        for key in keys:
+            yield f's3://{bucket}/{key}'
+        if not resp.get('IsTruncated'):
+            return
+        kwargs['ContinuationToken'] = resp['NextContinuationToken']
+
+
+def upload_fileobj(file_obj, s3_path: str) -> None:
+    """
+    Upload a binary file-like object to S3 without going through the local filesystem.
+    Large objects are sent as a multipart upload.
+    :param file_obj: readable binary file-like object, positioned at the start
+    :param s3_path: destination S3 path
+    """
+    bucket, key = _split_s3_path(s3_path)
+    _s3_client().upload_fileobj(file_obj, bucket, key)